@@ -1,25 +1,38 @@
 import json
+import operator
 import pathlib
+import stat
 import time
-from typing import Any, Dict, List, Literal, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 import fire
-from rich import box, console, table
-from tencentcloud.clb.v20180317.clb_client import ClbClient
-from tencentcloud.clb.v20180317.models import (
-    BatchModifyTargetWeightRequest,
-    DescribeLoadBalancersDetailRequest,
-    DescribeTargetsRequest,
-    RsWeightRule,
-    Target,
-)
-from tencentcloud.common.credential import Credential
-from tencentcloud.common.profile.client_profile import ClientProfile
-from tencentcloud.common.profile.http_profile import HttpProfile
+
+# tencentcloud SDK 和 rich 导入较慢，延迟到首次使用时再导入，加快命令启动
+if TYPE_CHECKING:
+    from rich.console import Console
+    from tencentcloud.clb.v20180317.clb_client import ClbClient
 
 XDG_DIR_CONFIG_FILE = pathlib.Path.home() / ".config" / "tc-clb-helper.json"
 CURRENT_DIR_CONFIG_FILE = pathlib.Path(__file__).parent / "tc-clb-helper.json"
 
+# 端口权重的 rich 渲染模板，权重为 0 红色并加粗
+_ONLINE_PORT_MARKUP = "[green]{}[{}][/green]"
+_OFFLINE_PORT_MARKUP = "[bold red]{}[{}][/bold red]"
+
+
+# 已解析的配置，key 为 (配置文件路径, mtime)，文件变更后自动失效
+_CONFIG_CACHE: Dict[Tuple[pathlib.Path, int], Dict[str, Any]] = {}
+
 
 def read_config():
     """按优先级读取配置文件，优先级从高到低为：
@@ -27,21 +40,28 @@ def read_config():
     - 当前目录的 tc-clb-helper.json
     - XDG 目录下的 tc-clb-helper.json
     """
-    if CURRENT_DIR_CONFIG_FILE.is_file():
-        config_file = CURRENT_DIR_CONFIG_FILE
-    elif XDG_DIR_CONFIG_FILE.is_file():
-        config_file = XDG_DIR_CONFIG_FILE
+    for config_file in (CURRENT_DIR_CONFIG_FILE, XDG_DIR_CONFIG_FILE):
+        try:
+            config_stat = config_file.stat()
+        except OSError:
+            continue
+        if stat.S_ISREG(config_stat.st_mode):
+            break
     else:
         raise Exception(
             f"配置文件 {CURRENT_DIR_CONFIG_FILE!s} 和 {XDG_DIR_CONFIG_FILE!s} 都不存在"
         )
 
+    cache_key = (config_file, config_stat.st_mtime_ns)
+    if cache_key in _CONFIG_CACHE:
+        return _CONFIG_CACHE[cache_key]
+
     try:
-        with open(config_file, "r") as fp:
-            content = json.load(fp=fp)
+        content = json.loads(config_file.read_bytes())
     except json.JSONDecodeError:
-        raise Exception("配置文件 {config_file!s} 不是合法的 JSON")
+        raise Exception(f"配置文件 {config_file!s} 不是合法的 JSON")
 
+    _CONFIG_CACHE[cache_key] = content
     return content
 
 
@@ -53,20 +73,57 @@ class TencentCloudCLBHelper:
         region="ap-shanghai",
         endpoint="clb.tencentcloudapi.com",
     ) -> None:
-        self._console = console.Console()
-        self._client = ClbClient(
-            credential=Credential(secret_id=secret_id, secret_key=secret_key),
-            region=region,
-            profile=ClientProfile(httpProfile=HttpProfile(endpoint=endpoint)),
-        )
+        self._secret_id = secret_id
+        self._secret_key = secret_key
+        self._region = region
+        self._endpoint = endpoint
+        # 延迟创建，见 _get_console 和 _get_client
+        self._console: Optional["Console"] = None
+        self._client: Optional["ClbClient"] = None
+        # DescribeLoadBalancersDetail 结果缓存，同一进程内只拉取一次
+        self._lb_cache: Optional[List[Dict[str, Any]]] = None
+
+    def _get_console(self) -> "Console":
+        """首次使用时创建 rich Console"""
+        if self._console is None:
+            from rich.console import Console
+
+            self._console = Console()
+        return self._console
+
+    def _get_client(self) -> "ClbClient":
+        """首次使用时创建 ClbClient"""
+        if self._client is None:
+            from tencentcloud.clb.v20180317.clb_client import ClbClient
+            from tencentcloud.common.credential import Credential
+            from tencentcloud.common.profile.client_profile import ClientProfile
+            from tencentcloud.common.profile.http_profile import HttpProfile
+
+            # 开启 keep-alive，同一次命令中的多次 API 请求复用 HTTPS 连接
+            http_profile = HttpProfile(
+                endpoint=self._endpoint, reqTimeout=30, keepAlive=True
+            )
+            self._client = ClbClient(
+                credential=Credential(
+                    secret_id=self._secret_id, secret_key=self._secret_key
+                ),
+                region=self._region,
+                profile=ClientProfile(httpProfile=http_profile),
+            )
+        return self._client
 
     def _render_table(
         self,
         table_title: str,
         table_columns: Tuple,
-        table_data: List[Dict[str, Any]],
+        table_rows: Iterable[Sequence[Any]],
     ):
-        """表格渲染打印"""
+        """表格渲染打印
+
+        table_rows 中每行的值按 table_columns 的顺序排列，可以是生成器
+        """
+        from rich import box, table
+
         # 初始化
         data_table = table.Table(
             title=table_title,
@@ -79,46 +136,73 @@ class TencentCloudCLBHelper:
         for column in table_columns:
             data_table.add_column(column)
         # 设置数据行
-        for row_data in table_data:
-            data_table.add_row(*[str(row_data.get(column)) for column in table_columns])
+        for row in table_rows:
+            data_table.add_row(*map(str, row))
         # print
-        self._console.print(data_table)
+        self._get_console().print(data_table)
 
     def _req_describe_load_balancers_detail(self) -> List[Dict[str, Any]]:
-        """SDK 请求 DescribeLoadBalancersDetail"""
+        """SDK 请求 DescribeLoadBalancersDetail，按 Offset 分页拉取全部 CLB"""
+        if self._lb_cache is not None:
+            return self._lb_cache
+
+        from tencentcloud.clb.v20180317.models import (
+            DescribeLoadBalancersDetailRequest,
+        )
+
+        page_size = 100
         req = DescribeLoadBalancersDetailRequest()
-        req.Limit = 100
-
-        resp = self._client.DescribeLoadBalancersDetail(req)
-        if resp.LoadBalancerDetailSet is None:
-            raise Exception("DescribeLoadBalancersDetail 失败")
-
-        return [
-            {
-                "LoadBalancerId": lb.LoadBalancerId,
-                "LoadBalancerName": lb.LoadBalancerName,
-                "Status": lb.Status,
-                "Address": lb.Address,
-            }
-            for lb in resp.LoadBalancerDetailSet
-        ]
+        req.Limit = page_size
+        req.Offset = 0
+
+        load_balancers = []
+        while True:
+            resp = self._get_client().DescribeLoadBalancersDetail(req)
+            if resp.LoadBalancerDetailSet is None:
+                # 只有第一页为 null 才是失败，后续页为 null 说明已经没有数据
+                if req.Offset == 0:
+                    raise Exception("DescribeLoadBalancersDetail 失败")
+                break
+
+            load_balancers.extend(
+                {
+                    "LoadBalancerId": lb.LoadBalancerId,
+                    "LoadBalancerName": lb.LoadBalancerName,
+                    "Status": lb.Status,
+                    "Address": lb.Address,
+                }
+                for lb in resp.LoadBalancerDetailSet
+            )
+            # 已拉取数量达到 TotalCount，或返回空页，说明已经是最后一页
+            if (
+                not resp.LoadBalancerDetailSet
+                or req.Offset + len(resp.LoadBalancerDetailSet) >= resp.TotalCount
+            ):
+                break
+            req.Offset += page_size
+
+        self._lb_cache = load_balancers
+        return load_balancers
 
     def list_clbs(self):
         """展示 CLB 列表"""
 
-        table_data = self._req_describe_load_balancers_detail()
+        table_columns = ("LoadBalancerId", "Address", "Status", "LoadBalancerName")
+        getter = operator.itemgetter(*table_columns)
         self._render_table(
             table_title="CLB 列表",
-            table_columns=("LoadBalancerId", "Address", "Status", "LoadBalancerName"),
-            table_data=table_data,
+            table_columns=table_columns,
+            table_rows=map(getter, self._req_describe_load_balancers_detail()),
         )
 
     def _req_describe_targets(self, clb_id: str):
         """SDK 请求 DescribeTargets"""
+        from tencentcloud.clb.v20180317.models import DescribeTargetsRequest
+
         # DescribeTargets
         req = DescribeTargetsRequest()
         req.LoadBalancerId = clb_id
-        resp = self._client.DescribeTargets(req)
+        resp = self._get_client().DescribeTargets(req)
         if resp.Listeners is None:
             raise Exception("DescribeTargets 失败，Listeners 为 None")
         if len(resp.Listeners) != 1:
@@ -134,37 +218,25 @@ class TencentCloudCLBHelper:
         targets_by_ip = {}
         for target in listener.Rules[0].Targets:
             private_ip = target.PrivateIpAddresses[0]
-            if private_ip not in targets_by_ip:
-                targets_by_ip[private_ip] = {
+            instance = targets_by_ip.setdefault(
+                private_ip,
+                {
                     "InstanceId": target.InstanceId,
                     "InstanceName": target.InstanceName,
                     "PrivateIpAddresses": private_ip,
                     "Ports": [],
-                }
-            targets_by_ip[private_ip]["Ports"].append((target.Port, target.Weight))
+                },
+            )
+            instance["Ports"].append((target.Port, target.Weight))
 
         # 按 InstanceName 排序后返回
         target_instances = sorted(
-            targets_by_ip.values(), key=lambda instance: instance["InstanceName"]
+            targets_by_ip.values(), key=operator.itemgetter("InstanceName")
         )
-        return list(target_instances), listener.ListenerId, listener.Rules[0].LocationId
-
-    def list_clb_targets(self, clb_id: str):
-        """按节点展示 CLB 后端列表"""
-        target_instances, _, _ = self._req_describe_targets(clb_id=clb_id)
-
-        # 处理一下数据
-        for i in target_instances:
-            # 计算该 instance 下总 Ports 数量
-            i["PortsAmount"] = len(i["Ports"])
-            # 根据 Ports 的权重用不同颜色渲染，权重为 0 红色并加粗
-            i["Port[Weight] List"] = " ".join(
-                f"[bold red]{port[0]}[{port[1]}][/bold red]"
-                if port[1] == 0
-                else f"[green]{port[0]}[{port[1]}][/green]"
-                for port in i["Ports"]
-            )
+        return target_instances, listener.ListenerId, listener.Rules[0].LocationId
 
+    def _render_clb_targets(self, clb_id: str, target_instances: List[Dict[str, Any]]):
+        """渲染打印 CLB 后端列表"""
         self._render_table(
             table_title=f"CLB 「{clb_id}」 后端列表",
             table_columns=(
@@ -174,103 +246,207 @@ class TencentCloudCLBHelper:
                 "PortsAmount",
                 "Port[Weight] List",
             ),
-            table_data=target_instances,
+            # 在渲染时逐行生成，不修改 target_instances
+            table_rows=(
+                (
+                    i["InstanceId"],
+                    i["InstanceName"],
+                    i["PrivateIpAddresses"],
+                    # 该 instance 下总 Ports 数量
+                    len(i["Ports"]),
+                    # 根据 Ports 的权重用不同颜色渲染
+                    " ".join(
+                        [
+                            (
+                                _OFFLINE_PORT_MARKUP
+                                if weight == 0
+                                else _ONLINE_PORT_MARKUP
+                            ).format(port, weight)
+                            for port, weight in i["Ports"]
+                        ]
+                    ),
+                )
+                for i in target_instances
+            ),
         )
 
+    def list_clb_targets(self, clb_id: str):
+        """按节点展示 CLB 后端列表"""
+        target_instances, _, _ = self._req_describe_targets(clb_id=clb_id)
+        self._render_clb_targets(clb_id=clb_id, target_instances=target_instances)
+
     def _req_batch_modify_target_weight(
         self,
         clb_id: str,
         listener_id: str,
         location_id: str,
-        instance_id: str,
-        ports: List[int],
-        weight: Literal[0, 10],
+        modifications: List[Tuple[str, List[int], Literal[0, 10]]],
     ):
-        """SDK 请求 BatchModifyTargetWeight"""
-        target_list = []
-        for port in ports:
-            target = Target()
-            target.InstanceId = instance_id
-            target.Port = port
-            target_list.append(target)
-
-        rule = RsWeightRule()
-        rule.ListenerId = listener_id
-        rule.LocationId = location_id
-        rule.Weight = weight
-        rule.Targets = target_list
+        """SDK 请求 BatchModifyTargetWeight
+
+        modifications 为 (instance_id, ports, weight) 列表，合并到一次请求中
+        """
+        from tencentcloud.clb.v20180317.models import (
+            BatchModifyTargetWeightRequest,
+            RsWeightRule,
+            Target,
+        )
+
+        rule_list = []
+        for instance_id, ports, weight in modifications:
+            target_list = []
+            for port in ports:
+                target = Target()
+                target.InstanceId = instance_id
+                target.Port = port
+                target_list.append(target)
+
+            rule = RsWeightRule()
+            rule.ListenerId = listener_id
+            rule.LocationId = location_id
+            rule.Weight = weight
+            rule.Targets = target_list
+            rule_list.append(rule)
 
         req = BatchModifyTargetWeightRequest()
         req.LoadBalancerId = clb_id
-        req.ModifyList = [rule]
+        req.ModifyList = rule_list
 
-        return self._client.BatchModifyTargetWeight(req)
+        return self._get_client().BatchModifyTargetWeight(req)
 
-    def _change_clb_instance_weight(
+    def _change_clb_instances_weight(
         self,
         clb_id: str,
-        instance_id: str,
+        instance_ids: Tuple[str, ...],
         weight: Literal[0, 10],
+        targets: Tuple[List[Dict[str, Any]], str, str],
     ):
-        """修改 CLB 后端中单个节点所有端口的权重"""
-        target_instances, listener_id, location_id = self._req_describe_targets(
-            clb_id=clb_id
-        )
+        """修改 CLB 后端中多个节点所有端口的权重
+
+        targets 为 _req_describe_targets 的返回值，由调用方传入以避免重复请求
+        """
+        target_instances, listener_id, location_id = targets
+
+        instances_by_id = {i["InstanceId"]: i for i in target_instances}
+
+        # 先检查要操作的节点在 CLB 后端中存在，节点不存在时无需再做下面的检查
+        modifications = []
+        for instance_id in instance_ids:
+            current_instance = instances_by_id.get(instance_id)
+            if current_instance is None:
+                raise Exception(f"CLB {clb_id} 的后端中没有节点 {instance_id} 的端口")
+            modifications.append(
+                (
+                    instance_id,
+                    list(map(operator.itemgetter(0), current_instance["Ports"])),
+                    weight,
+                )
+            )
 
         # 如果是下线操作，检查其他节点必须有端口权重不为 0
         if weight == 0:
-            others_offline = True
-            for instance in target_instances:
-                # 跳过当前节点
-                if instance["InstanceId"] == instance_id:
-                    continue
-                for port in instance["Ports"]:
-                    if port[1] != 0:
-                        others_offline = False
-                        break
-                if not others_offline:
-                    break
-
-            if others_offline:
-                raise Exception(f"CLB {clb_id} 除 {instance_id} 外的其他节点都为离线，禁止操作，否则服务挂掉！")
-
-        # 检查要操作的节点在 CLB 后端中存在
-        current_instance = None
-        for instance in target_instances:
-            if instance["InstanceId"] == instance_id:
-                current_instance = instance
-                break
-        if not current_instance:
-            raise Exception(f"CLB {clb_id} 的后端中没有节点 {instance_id} 的端口")
+            excluded_ids = set(instance_ids)
+            # 遇到第一个权重不为 0 的端口即停止扫描
+            others_online = any(
+                port_weight != 0
+                for instance in target_instances
+                if instance["InstanceId"] not in excluded_ids
+                for _, port_weight in instance["Ports"]
+            )
+            if not others_online:
+                raise Exception(
+                    f"CLB {clb_id} 除 {', '.join(instance_ids)} 外的其他节点都为离线，"
+                    "禁止操作，否则服务挂掉！"
+                )
 
         resp = self._req_batch_modify_target_weight(
             clb_id=clb_id,
             listener_id=listener_id,
             location_id=location_id,
-            instance_id=instance_id,
-            ports=[port[0] for port in current_instance["Ports"]],
-            weight=weight,
+            modifications=modifications,
         )
-        self._console.print("接口返回", resp)
-        self._console.print("延时 3 秒等待生效...")
+        self._get_console().print("接口返回", resp)
+        self._get_console().print("等待生效...")
+
+    def _wait_for_weight(
+        self,
+        clb_id: str,
+        instance_ids: Tuple[str, ...],
+        expected_weight: Literal[0, 10],
+        timeout: float = 10,
+    ) -> List[Dict[str, Any]]:
+        """轮询 DescribeTargets 直到节点所有端口的权重生效或超时
+
+        返回最后一次请求得到的后端列表，供调用方直接渲染
+        """
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        waiting_ids = set(instance_ids)
+        while True:
+            target_instances, _, _ = self._req_describe_targets(clb_id=clb_id)
+            if all(
+                port_weight == expected_weight
+                for instance in target_instances
+                if instance["InstanceId"] in waiting_ids
+                for _, port_weight in instance["Ports"]
+            ):
+                return target_instances
+
+            # 指数退避，单次最多等待 1 秒
+            delay = min(0.25 * 2**attempt, 1, deadline - time.monotonic())
+            if delay <= 0:
+                self._get_console().print(
+                    f"[bold red]等待 {timeout} 秒后权重仍未全部生效[/bold red]"
+                )
+                return target_instances
+            time.sleep(delay)
+            attempt += 1
+
+    def _set_clb_instances_weight(
+        self,
+        clb_id: str,
+        instance_ids: Tuple[str, ...],
+        weight: Literal[0, 10],
+    ):
+        """展示后端列表，修改节点权重，等待生效后再次展示"""
+        # 去重并保持命令行中的顺序，避免同一节点重复出现在 ModifyList 中
+        instance_ids = tuple(dict.fromkeys(instance_ids))
+        if not instance_ids:
+            raise Exception("至少需要指定一个节点")
+
+        targets = self._req_describe_targets(clb_id=clb_id)
+        self._render_clb_targets(clb_id=clb_id, target_instances=targets[0])
+        self._change_clb_instances_weight(
+            clb_id=clb_id, instance_ids=instance_ids, weight=weight, targets=targets
+        )
+        target_instances = self._wait_for_weight(
+            clb_id=clb_id, instance_ids=instance_ids, expected_weight=weight
+        )
+        self._render_clb_targets(clb_id=clb_id, target_instances=target_instances)
 
     def online_clb_instance(self, clb_id: str, instance_id: str):
         """按节点批量上线 CLB 后端端口"""
-        self.list_clb_targets(clb_id=clb_id)
-        self._change_clb_instance_weight(
-            clb_id=clb_id, instance_id=instance_id, weight=10
+        self._set_clb_instances_weight(
+            clb_id=clb_id, instance_ids=(instance_id,), weight=10
         )
-        time.sleep(3)
-        self.list_clb_targets(clb_id=clb_id)
 
     def offline_clb_instance(self, clb_id: str, instance_id: str):
         """按节点批量下线 CLB 后端端口"""
-        self.list_clb_targets(clb_id=clb_id)
-        self._change_clb_instance_weight(
-            clb_id=clb_id, instance_id=instance_id, weight=0
+        self._set_clb_instances_weight(
+            clb_id=clb_id, instance_ids=(instance_id,), weight=0
+        )
+
+    def online_clb_instances(self, clb_id: str, *instance_ids: str):
+        """批量上线多个节点的 CLB 后端端口，合并为一次接口请求"""
+        self._set_clb_instances_weight(
+            clb_id=clb_id, instance_ids=instance_ids, weight=10
+        )
+
+    def offline_clb_instances(self, clb_id: str, *instance_ids: str):
+        """批量下线多个节点的 CLB 后端端口，合并为一次接口请求"""
+        self._set_clb_instances_weight(
+            clb_id=clb_id, instance_ids=instance_ids, weight=0
         )
-        time.sleep(3)
-        self.list_clb_targets(clb_id=clb_id)
 
 
 if __name__ == "__main__":